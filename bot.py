@@ -1,20 +1,26 @@
 import asyncio
+import functools
 import logging
+import os
 import re
-import json
-import sqlite3
+import aiosqlite
 import hashlib
-import random
-import string
+import secrets
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
+try:
+    import uvloop
+except ImportError:  # uvloop is optional and not available on Windows
+    uvloop = None
 from telegram import (
     Update, ChatPermissions, InlineKeyboardButton, InlineKeyboardMarkup, 
     ChatMemberAdministrator, ChatMemberOwner
 )
 from telegram.ext import (
     Application,
-    CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
@@ -28,253 +34,701 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# SQL shared by several call sites lives here so each statement is written once.
+# sqlite3 caches prepared statements by SQL text; STATEMENT_CACHE_SIZE raises the
+# per-connection cache from its default of 128 entries
+STATEMENT_CACHE_SIZE = 256
+SQL_SELECT_ROLE = "SELECT role FROM users WHERE user_id=? AND group_id=?"
+SQL_SELECT_POINTS = "SELECT points FROM users WHERE user_id=? AND group_id=?"
+SQL_SET_ROLE = "UPDATE users SET role=? WHERE user_id=? AND group_id=?"
+SQL_WARN_USER = (
+    "UPDATE users SET warnings = warnings + 1 "
+    "WHERE user_id = ? AND group_id = ? RETURNING warnings"
+)
+
+SQL_REGISTER_GROUP = "INSERT OR IGNORE INTO groups (group_id, title, created_at) VALUES (?, ?, ?)"
+SQL_REGISTER_USER = (
+    "INSERT OR IGNORE INTO users (user_id, group_id, username, joined_at) "
+    "VALUES (?, ?, ?, ?)"
+)
+SQL_INSERT_MESSAGE = "INSERT INTO messages (group_id, user_id, content, timestamp) VALUES (?, ?, ?, ?)"
+# Creates the user on first sight, otherwise adds to their points; one B-tree probe per row
+SQL_UPSERT_POINTS = (
+    "INSERT INTO users (user_id, group_id, username, joined_at, points) VALUES (?, ?, ?, ?, ?) "
+    "ON CONFLICT(user_id, group_id) DO UPDATE SET "
+    "points = points + excluded.points, username = excluded.username"
+)
+
+# Retries before giving up on a colliding short code
+SHORT_CODE_ATTEMPTS = 3
+
+# Upper bound on how many upcoming events /showevents lists
+SHOW_EVENTS_LIMIT = 50
+
+# Queued registrations and buffered chat messages are flushed every
+# WRITE_BEHIND_INTERVAL seconds, or sooner once WRITE_BEHIND_MAX_ROWS
+# registrations or MESSAGE_BUFFER_MAX_ROWS messages are waiting
+WRITE_BEHIND_INTERVAL = 0.2
+WRITE_BEHIND_MAX_ROWS = 100
+MESSAGE_BUFFER_MAX_ROWS = 500
+# While the database keeps failing, requeued messages beyond this many are
+# dropped, oldest first; registrations are one per user and stay queued
+MESSAGE_BACKLOG_MAX_ROWS = 10000
+
+# Message points are aggregated in memory and applied every POINTS_FLUSH_INTERVAL seconds
+POINTS_FLUSH_INTERVAL = 5
+
+# SQLite checkpoints the WAL itself every WAL_AUTOCHECKPOINT pages; a PASSIVE
+# checkpoint every WAL_CHECKPOINT_INTERVAL seconds keeps it short between bursts
+WAL_AUTOCHECKPOINT = 1000
+WAL_CHECKPOINT_INTERVAL = 60
+
+# How long (seconds) admin status and role lookups are trusted before re-checking
+ROLE_CACHE_TTL = 60
+
+class AioSqlitePool:
+    """One read-write connection guarded by a lock plus N read-only connections."""
+
+    def __init__(self, db_name: str, readers: int = 4):
+        self.db_name = db_name
+        self.size = readers
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue = asyncio.Queue()
+        self._reader_conns: List[aiosqlite.Connection] = []
+
+    async def open(self):
+        self._writer = await aiosqlite.connect(self.db_name, cached_statements=STATEMENT_CACHE_SIZE)
+        await self._configure(self._writer, writable=True)
+        for _ in range(self.size):
+            conn = await aiosqlite.connect(
+                f"file:{self.db_name}?mode=ro", uri=True, cached_statements=STATEMENT_CACHE_SIZE
+            )
+            await self._configure(conn, writable=False)
+            self._reader_conns.append(conn)
+            self._readers.put_nowait(conn)
+
+    async def _configure(self, conn: aiosqlite.Connection, writable: bool):
+        await conn.executescript('''
+            PRAGMA temp_store = MEMORY;
+            PRAGMA mmap_size = 268435456;
+            PRAGMA cache_size = -65536;
+        ''')
+        if writable:
+            # WAL lets readers run alongside the writer; NORMAL only fsyncs on checkpoint
+            await conn.executescript(f'''
+                PRAGMA foreign_keys = 1;
+                PRAGMA journal_mode = WAL;
+                PRAGMA synchronous = NORMAL;
+                PRAGMA wal_autocheckpoint = {WAL_AUTOCHECKPOINT};
+            ''')
+
+    async def close(self):
+        for conn in self._reader_conns:
+            await conn.close()
+        self._reader_conns.clear()
+        self._readers = asyncio.Queue()
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """Borrow a read-only connection for SELECT statements."""
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Hold the single read-write connection; rolls back if the block raises."""
+        async with self._write_lock:
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
 class Database:
-    def __init__(self, db_name: str = 'group_manager.db'):
-        self.conn = sqlite3.connect(db_name)
-        self.conn.execute("PRAGMA foreign_keys = 1;")
-        self.create_tables()
+    def __init__(self, db_name: str = 'group_manager.db', readers: int = 4):
+        self.pool = AioSqlitePool(db_name, readers)
+
+    async def connect(self):
+        """Open the connection pool and make sure the schema exists."""
+        await self.pool.open()
+        await self.create_tables()
+
+    async def close(self):
+        await self.pool.close()
+
+    def reader(self):
+        return self.pool.reader()
+
+    def writer(self):
+        return self.pool.writer()
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[tuple]:
+        """Run a read on a pooled reader and return its first row, in one worker round-trip."""
+        async with self.reader() as conn:
+            rows = await conn.execute_fetchall(sql, params)
+        return rows[0] if rows else None
+
+    async def checkpoint(self):
+        """Copy committed WAL frames into the database without blocking readers or waiting on them."""
+        async with self.writer() as conn:
+            await conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
     
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.executescript('''
-            CREATE TABLE IF NOT EXISTS groups (
-                group_id INTEGER PRIMARY KEY,
-                title TEXT,
-                settings TEXT,
-                created_at TIMESTAMP,
-                welcome_message TEXT,
-                rules TEXT
-            );
+    async def create_tables(self):
+        async with self.writer() as conn:
+            # Older schemas pointed messages.user_id at users (user_id) alone, which
+            # is not a key of users, so SQLite rejected every message insert with
+            # "foreign key mismatch". Move such a table aside and rebuild it below.
+            async with conn.execute(
+                "SELECT name, sql FROM sqlite_master "
+                "WHERE name IN ('messages', 'messages_old', 'event_rsvps', 'idx_rsvp_unique')"
+            ) as cursor:
+                schema_sql = dict(await cursor.fetchall())
+            legacy_messages = "REFERENCES users (user_id)" in schema_sql.get("messages", "")
+            # A leftover messages_old means an earlier rebuild stopped before copying back
+            rebuild_messages = legacy_messages or "messages_old" in schema_sql
+            # event_rsvps tables created before UNIQUE (event_id, user_id) need a unique index instead
+            legacy_rsvps = ("event_rsvps" in schema_sql
+                            and "UNIQUE (event_id, user_id)" not in schema_sql["event_rsvps"])
+            if legacy_messages and "messages_old" not in schema_sql:
+                await conn.executescript('''
+                    ALTER TABLE messages RENAME TO messages_old;
+                    DROP INDEX IF EXISTS idx_messages_group_user;
+                    DROP INDEX IF EXISTS idx_messages_group_time;
+                ''')
+
+            await conn.executescript('''
+                CREATE TABLE IF NOT EXISTS groups (
+                    group_id INTEGER PRIMARY KEY,
+                    title TEXT,
+                    settings TEXT,
+                    created_at INTEGER,
+                    welcome_message TEXT,
+                    rules TEXT
+                );
             
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER,
-                group_id INTEGER,
-                username TEXT,
-                role TEXT DEFAULT 'member',
-                joined_at TIMESTAMP,
-                warnings INTEGER DEFAULT 0,
-                points INTEGER DEFAULT 0,
-                FOREIGN KEY (group_id) REFERENCES groups (group_id),
-                PRIMARY KEY (user_id, group_id)
-            );
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER,
+                    group_id INTEGER,
+                    username TEXT,
+                    role TEXT DEFAULT 'member',
+                    joined_at INTEGER,
+                    warnings INTEGER DEFAULT 0,
+                    points INTEGER DEFAULT 0,
+                    FOREIGN KEY (group_id) REFERENCES groups (group_id),
+                    PRIMARY KEY (user_id, group_id)
+                );
             
-            CREATE TABLE IF NOT EXISTS messages (
-                message_id INTEGER PRIMARY KEY,
-                group_id INTEGER,
-                user_id INTEGER,
-                content TEXT,
-                timestamp TIMESTAMP,
-                FOREIGN KEY (group_id) REFERENCES groups (group_id),
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            );
+                CREATE TABLE IF NOT EXISTS messages (
+                    message_id INTEGER PRIMARY KEY,
+                    group_id INTEGER,
+                    user_id INTEGER,
+                    content TEXT,
+                    timestamp INTEGER,
+                    FOREIGN KEY (group_id) REFERENCES groups (group_id),
+                    FOREIGN KEY (user_id, group_id) REFERENCES users (user_id, group_id)
+                );
             
-            CREATE TABLE IF NOT EXISTS shortened_urls (
-                short_code TEXT PRIMARY KEY,
-                original_url TEXT,
-                created_at TIMESTAMP,
-                created_by INTEGER
-            );
+                CREATE TABLE IF NOT EXISTS shortened_urls (
+                    short_code TEXT PRIMARY KEY,
+                    original_url TEXT,
+                    created_at INTEGER,
+                    created_by INTEGER
+                );
             
-            CREATE TABLE IF NOT EXISTS polls (
-                poll_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER,
-                question TEXT,
-                options TEXT,
-                created_at TIMESTAMP,
-                is_active INTEGER DEFAULT 1
-            );
+                CREATE TABLE IF NOT EXISTS polls (
+                    poll_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_id INTEGER,
+                    question TEXT,
+                    options TEXT,
+                    created_at INTEGER,
+                    is_active INTEGER DEFAULT 1
+                );
             
-            CREATE TABLE IF NOT EXISTS poll_responses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                poll_id INTEGER,
-                user_id INTEGER,
-                selected_option TEXT,
-                FOREIGN KEY (poll_id) REFERENCES polls (poll_id)
-            );
+                CREATE TABLE IF NOT EXISTS poll_options (
+                    poll_id INTEGER,
+                    option_text TEXT,
+                    FOREIGN KEY (poll_id) REFERENCES polls (poll_id),
+                    PRIMARY KEY (poll_id, option_text)
+                );
             
-            CREATE TABLE IF NOT EXISTS events (
-                event_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                group_id INTEGER,
-                title TEXT,
-                scheduled_time TIMESTAMP,
-                description TEXT,
-                created_by INTEGER
-            );
+                CREATE TABLE IF NOT EXISTS poll_responses (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    poll_id INTEGER,
+                    user_id INTEGER,
+                    selected_option TEXT,
+                    FOREIGN KEY (poll_id) REFERENCES polls (poll_id)
+                );
             
-            CREATE TABLE IF NOT EXISTS event_rsvps (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                event_id INTEGER,
-                user_id INTEGER,
-                status TEXT,
-                FOREIGN KEY (event_id) REFERENCES events (event_id)
-            );
-        ''')
-        self.conn.commit()
+                CREATE TABLE IF NOT EXISTS events (
+                    event_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    group_id INTEGER,
+                    title TEXT,
+                    scheduled_time TIMESTAMP,
+                    description TEXT,
+                    created_by INTEGER
+                );
+            
+                CREATE TABLE IF NOT EXISTS event_rsvps (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event_id INTEGER,
+                    user_id INTEGER,
+                    status TEXT,
+                    FOREIGN KEY (event_id) REFERENCES events (event_id),
+                    UNIQUE (event_id, user_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS idx_events_group_time ON events (group_id, scheduled_time);
+                CREATE INDEX IF NOT EXISTS idx_poll_responses_option ON poll_responses (poll_id, selected_option);
+                CREATE INDEX IF NOT EXISTS idx_messages_group_user ON messages (group_id, user_id);
+                CREATE INDEX IF NOT EXISTS idx_messages_group_time ON messages (group_id, timestamp);
+            ''')
+
+            if legacy_rsvps and "idx_rsvp_unique" not in schema_sql:
+                # Older tables may hold duplicate RSVPs; keep the latest answer so the
+                # unique index that ON CONFLICT (event_id, user_id) relies on can be built
+                await conn.executescript('''
+                    DELETE FROM event_rsvps WHERE id NOT IN (
+                        SELECT MAX(id) FROM event_rsvps GROUP BY event_id, user_id
+                    );
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_rsvp_unique ON event_rsvps (event_id, user_id);
+                ''')
+
+            if rebuild_messages:
+                await conn.executescript('''
+                    PRAGMA foreign_keys = 0;
+                    BEGIN;
+                    INSERT OR IGNORE INTO messages SELECT * FROM messages_old;
+                    DROP TABLE messages_old;
+                    COMMIT;
+                    PRAGMA foreign_keys = 1;
+                ''')
+
+            # user_version records one-off data migrations that have already run
+            async with conn.execute("PRAGMA user_version") as cursor:
+                (user_version,) = await cursor.fetchone()
+            if user_version < 1:
+                # Messages used to be stamped with datetime.now() as local-time
+                # text; store them as epoch seconds like newly logged ones
+                await conn.execute('''
+                    UPDATE messages SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                    WHERE typeof(timestamp) = 'text'
+                ''')
+            if user_version < 2:
+                # Polls created before poll_options existed kept their options as a
+                # JSON array in polls.options; copy them over, skipping malformed values
+                await conn.execute('''
+                    INSERT OR IGNORE INTO poll_options (poll_id, option_text)
+                    SELECT polls.poll_id, json_each.value FROM polls, json_each(polls.options)
+                    WHERE json_valid(polls.options)
+                      AND polls.poll_id NOT IN (SELECT poll_id FROM poll_options)
+                ''')
+                await conn.execute("PRAGMA user_version = 2")
+            await conn.commit()
+
+# Static reply texts
+_WELCOME_TEXT = (
+    "Hello! I'm your expanded GroupManager Bot.\n"
+    "• Use /help to see what I can do.\n"
+    "• Use /setwelcome <message> to customize an automatic welcome.\n"
+    "• Use /setrules <rules> to set or update the group rules.\n\n"
+    "Happy managing!"
+)
 
-# Utility function to get role priority
-# Higher return value indicates higher privilege
+_HELP_TEXT = (
+    "**Available Commands:**\n\n"
+    "/start - Bot introduction and setup\n"
+    "/help - Display this help message\n"
+    "/rules - Show current group rules\n"
+    "/setrules <rules> - Set or update group rules (admin only)\n"
+    "/ban <user_id> [reason] - Ban a user (admin only)\n"
+    "/unban <user_id> - Unban a user (admin only)\n"
+    "/mute <user_id> [minutes] - Temporarily mute a user (admin only)\n"
+    "/unmute <user_id> - Unmute a user (admin only)\n"
+    "/warn <user_id> [reason] - Warn a user (admin only)\n"
+    "/shorturl <url> - Shorten a given URL\n"
+    "/setwelcome <message> - Customize welcome message (admin only)\n"
+    "/points <user_id> - Check a user’s points\n"
+    "/poll <question>|<option1>|<option2>|... - Create a poll\n"
+    "/vote <poll_id> <option> - Vote on a poll\n"
+    "/stoppoll <poll_id> - Stop an active poll (admin only)\n"
+    "/createevent <title>|<YYYY-MM-DD HH:MM>|<description> - Schedule an event\n"
+    "/rsvp <event_id> <yes/no/maybe> - RSVP to an event\n"
+    "/showevents - Show upcoming events\n"
+    "/promote <user_id> <role> - Promote a user to a higher role (owner/admin only)\n"
+    "/demote <user_id> - Demote a user to a lower role (owner/admin only)\n"
+    "/lockdown <on/off> - Restrict or allow messages for most users\n"
+)
+
+# Role priorities: higher value indicates higher privilege
 # E.g: owner -> 4, admin -> 3, moderator -> 2, member -> 1
+_ROLE_PRIORITY = {
+    'owner': 4,
+    'creator': 4,
+    'superadmin': 3,
+    'administrator': 3,
+    'admin': 3,
+    'moderator': 2,
+    'member': 1,
+    'restricted': 0
+}
+
+# Canonical role name for each priority, used when demoting one step
+_PRIORITY_TO_ROLE = {4: 'owner', 3: 'administrator', 2: 'moderator', 1: 'member'}
+
+_URL_SCHEME_RE = re.compile(r'https?://')
+
+# Utility function to get role priority
 def get_role_priority(role: str) -> int:
-    role_map = {
-        'owner': 4,
-        'creator': 4,
-        'superadmin': 3,
-        'administrator': 3,
-        'admin': 3,
-        'moderator': 2,
-        'member': 1,
-        'restricted': 0
-    }
-    return role_map.get(role.lower(), 1)
+    return _ROLE_PRIORITY.get(role.lower(), 1)
+
+def admin_only(fn):
+    """Decorator for GroupManager handlers that only chat admins may run."""
+    @functools.wraps(fn)
+    async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not await self.check_admin(update, context):
+            await update.message.reply_text("❌ Admin privileges required.")
+            return
+        return await fn(self, update, context)
+    return wrapper
 
 class GroupManager:
+    # Chat-wide permissions for /lockdown on and off. PTB 20 split the old
+    # can_send_media_messages flag into one flag per media type.
+    _PERMS_LOCKED = ChatPermissions(
+        can_send_messages=False,
+        can_send_audios=False,
+        can_send_documents=False,
+        can_send_photos=False,
+        can_send_videos=False,
+        can_send_video_notes=False,
+        can_send_voice_notes=False,
+        can_send_polls=False,
+        can_send_other_messages=False,
+        can_add_web_page_previews=False
+    )
+    _PERMS_OPEN = ChatPermissions(
+        can_send_messages=True,
+        can_send_audios=True,
+        can_send_documents=True,
+        can_send_photos=True,
+        can_send_videos=True,
+        can_send_video_notes=True,
+        can_send_voice_notes=True,
+        can_send_polls=True,
+        can_send_other_messages=True,
+        can_add_web_page_previews=True
+    )
+    # Per-user permissions restored by /unmute
+    _PERMS_UNMUTED = ChatPermissions(
+        can_send_messages=True,
+        can_send_audios=True,
+        can_send_documents=True,
+        can_send_photos=True,
+        can_send_videos=True,
+        can_send_video_notes=True,
+        can_send_voice_notes=True,
+        can_send_polls=True,
+        can_send_other_messages=True,
+        can_add_web_page_previews=True,
+        can_change_info=False,
+        can_invite_users=True,
+        can_pin_messages=False
+    )
+
     def __init__(self, token: str):
         self.db = Database()
-        self.application = Application.builder().token(token).build()
+        # chat_id -> (monotonic timestamp, admin user ids)
+        self._admin_cache: Dict[int, Tuple[float, set]] = {}
+        # (chat_id, user_id) -> (monotonic timestamp, role)
+        self._role_cache: Dict[Tuple[int, int], Tuple[float, str]] = {}
+        # (chat_id, user_id) -> (chat title, username) registrations waiting to be written
+        self._pending_upserts: Dict[Tuple[int, int], Tuple[str, str]] = {}
+        # (chat_id, user_id, text, timestamp) messages waiting to be logged
+        self._msg_buffer: List[tuple] = []
+        # (chat_id, user_id) -> points earned since the last points flush
+        self._points: Counter = Counter()
+        # (chat_id, user_id) -> (chat title, username) for users in self._points
+        self._point_owners: Dict[Tuple[int, int], Tuple[str, str]] = {}
+        self._flush_wakeup = asyncio.Event()
+        # Held by the background loops while they write, so shutdown never cancels mid-flush
+        self._flush_lock = asyncio.Lock()
+        self._background_tasks: List[asyncio.Task] = []
+        self.application = (
+            Application.builder()
+            .token(token)
+            .post_init(self.post_init)
+            .post_shutdown(self.post_shutdown)
+            .build()
+        )
         self.setup_handlers()
 
-    def setup_handlers(self):
-        command_handlers = [
-            CommandHandler("start", self.cmd_start),
-            CommandHandler("help", self.cmd_help),
-            CommandHandler("rules", self.cmd_rules),
-            CommandHandler("setrules", self.cmd_setrules),
-            CommandHandler("ban", self.cmd_ban),
-            CommandHandler("unban", self.cmd_unban),
-            CommandHandler("mute", self.cmd_mute),
-            CommandHandler("unmute", self.cmd_unmute),
-            CommandHandler("warn", self.cmd_warn),
-            CommandHandler("shorturl", self.cmd_shorturl),
-            CommandHandler("setwelcome", self.cmd_setwelcome),
-            CommandHandler("points", self.cmd_points),
-            CommandHandler("poll", self.cmd_poll),
-            CommandHandler("vote", self.cmd_vote),
-            CommandHandler("stoppoll", self.cmd_stoppoll),
-            CommandHandler("createevent", self.cmd_createevent),
-            CommandHandler("rsvp", self.cmd_rsvp),
-            CommandHandler("showevents", self.cmd_showevents),
-            CommandHandler("promote", self.cmd_promote),
-            CommandHandler("demote", self.cmd_demote),
-            CommandHandler("lockdown", self.cmd_lockdown)
+    async def post_init(self, application: Application):
+        """Open the database once the event loop is running."""
+        await self.db.connect()
+        self._background_tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._points_loop()),
+            asyncio.create_task(self._checkpoint_loop())
         ]
+
+    async def post_shutdown(self, application: Application):
+        """Flush queued writes and close the database when the application stops."""
+        # Let an in-flight flush finish, then cancel the loops while they are idle
+        async with self._flush_lock:
+            for task in self._background_tasks:
+                task.cancel()
+            await asyncio.gather(*self._background_tasks, return_exceptions=True)
+        self._background_tasks = []
+        # A failed message flush must not cost the points, nor leak the pool
+        try:
+            await self.flush_pending()
+        finally:
+            try:
+                await self.flush_points()
+            finally:
+                await self.db.close()
+
+    async def _flush_loop(self):
+        """Background task that periodically persists queued writes."""
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_wakeup.wait(), WRITE_BEHIND_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_wakeup.clear()
+            try:
+                async with self._flush_lock:
+                    await self.flush_pending()
+            except Exception as e:
+                logger.error(f"Write-behind flush error: {e}")
+
+    async def flush_pending(self):
+        """Write all queued registrations and buffered messages in a single transaction."""
+        if not self._pending_upserts and not self._msg_buffer:
+            return
+        # Swap the buffers out so handlers can keep appending while we write
+        rows, self._pending_upserts = self._pending_upserts, {}
+        messages, self._msg_buffer = self._msg_buffer, []
+        # One epoch timestamp stamps the whole batch
+        ts = int(time.time())
+
+        try:
+            async with self.db.writer() as conn:
+                await conn.execute("BEGIN IMMEDIATE")
+                # Groups, then users, so the foreign keys of users and messages are satisfied
+                titles = {chat_id: title for (chat_id, _), (title, _) in rows.items()}
+                await conn.executemany(SQL_REGISTER_GROUP, [(chat_id, title, ts) for chat_id, title in titles.items()])
+                await conn.executemany(SQL_REGISTER_USER, [(user_id, chat_id, username, ts)
+                                                           for (chat_id, user_id), (_, username) in rows.items()])
+                await conn.executemany(SQL_INSERT_MESSAGE, messages)
+                await conn.commit()
+        except BaseException:
+            # The transaction was rolled back; requeue the batch ahead of newer rows
+            self._pending_upserts = {**rows, **self._pending_upserts}
+            self._msg_buffer[:0] = messages
+            overflow = len(self._msg_buffer) - MESSAGE_BACKLOG_MAX_ROWS
+            if overflow > 0:
+                del self._msg_buffer[:overflow]
+                logger.error(f"Message backlog full, dropped {overflow} oldest messages")
+            raise
+
+    async def _points_loop(self):
+        """Background task that periodically applies aggregated points."""
+        while True:
+            await asyncio.sleep(POINTS_FLUSH_INTERVAL)
+            try:
+                async with self._flush_lock:
+                    await self.flush_points()
+            except Exception as e:
+                logger.error(f"Points flush error: {e}")
+
+    async def _checkpoint_loop(self):
+        """Background task that bounds WAL growth with periodic passive checkpoints."""
+        while True:
+            await asyncio.sleep(WAL_CHECKPOINT_INTERVAL)
+            try:
+                async with self._flush_lock:
+                    await self.db.checkpoint()
+            except Exception as e:
+                logger.error(f"WAL checkpoint error: {e}")
+
+    async def flush_points(self):
+        """Upsert every pending points increment, registering unseen users on the way."""
+        if not self._points:
+            return
+        snapshot, self._points = self._points, Counter()
+        owners, self._point_owners = self._point_owners, {}
+        ts = int(time.time())
+
+        try:
+            async with self.db.writer() as conn:
+                await conn.execute("BEGIN IMMEDIATE")
+                # Groups first so the users foreign key is satisfied
+                titles = {chat_id: title for (chat_id, _), (title, _) in owners.items()}
+                await conn.executemany(SQL_REGISTER_GROUP, [(chat_id, title, ts) for chat_id, title in titles.items()])
+                await conn.executemany(SQL_UPSERT_POINTS, [(user_id, chat_id, owners[(chat_id, user_id)][1], ts, earned)
+                                                           for (chat_id, user_id), earned in snapshot.items()])
+                await conn.commit()
+        except BaseException:
+            # Nothing was applied; fold the snapshot back into the live counter
+            self._points.update(snapshot)
+            self._point_owners = {**owners, **self._point_owners}
+            raise
+
+    def queue_registration(self, chat_id: int, title: str, user_id: int, username: str):
+        """Defer the group/user INSERT OR IGNORE to the next write-behind flush."""
+        self._pending_upserts[(chat_id, user_id)] = (title, username)
+        if len(self._pending_upserts) >= WRITE_BEHIND_MAX_ROWS:
+            self._flush_wakeup.set()
+
+    def buffer_message(self, chat_id: int, user_id: int, text: str):
+        """Defer logging a chat message to the next write-behind flush."""
+        self._msg_buffer.append((chat_id, user_id, text, int(time.time())))
+        if len(self._msg_buffer) >= MESSAGE_BUFFER_MAX_ROWS:
+            self._flush_wakeup.set()
+
+    def setup_handlers(self):
+        # Command name -> handler; routed by _dispatch with a single dict lookup
+        self._commands = {
+            "start": self.cmd_start,
+            "help": self.cmd_help,
+            "rules": self.cmd_rules,
+            "setrules": self.cmd_setrules,
+            "ban": self.cmd_ban,
+            "unban": self.cmd_unban,
+            "mute": self.cmd_mute,
+            "unmute": self.cmd_unmute,
+            "warn": self.cmd_warn,
+            "shorturl": self.cmd_shorturl,
+            "setwelcome": self.cmd_setwelcome,
+            "points": self.cmd_points,
+            "poll": self.cmd_poll,
+            "vote": self.cmd_vote,
+            "stoppoll": self.cmd_stoppoll,
+            "createevent": self.cmd_createevent,
+            "rsvp": self.cmd_rsvp,
+            "showevents": self.cmd_showevents,
+            "promote": self.cmd_promote,
+            "demote": self.cmd_demote,
+            "lockdown": self.cmd_lockdown
+        }
+        # Callback action (the part of query.data before ':') -> handler(query, payload)
+        self._callback_handlers = {
+            "some_action": self._handle_some_action
+        }
         
-        message_handler = MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message)
+        # Same updates CommandHandler accepts by default: messages and their edits, no channel posts
+        command_handler = MessageHandler(filters.UpdateType.MESSAGES & filters.COMMAND, self._dispatch)
+        # New messages only: edits and channel posts never reach handle_message
+        message_handler = MessageHandler(
+            filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND, self.handle_message
+        )
         callback_handler = CallbackQueryHandler(self.handle_callback)
 
-        for handler in command_handlers:
-            self.application.add_handler(handler)
-
+        self.application.add_handler(command_handler)
         self.application.add_handler(message_handler)
         self.application.add_handler(callback_handler)
 
+    async def _dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Route a /command to its handler, filling context.args like CommandHandler does."""
+        words = update.effective_message.text.split()
+        command, _, target = words[0][1:].partition("@")
+        # Ignore commands addressed to a different bot, e.g. /start@other_bot
+        if target and target.lower() != context.bot.username.lower():
+            return
+
+        handler = self._commands.get(command.lower())
+        if handler is None:
+            return
+        context.args = words[1:]
+        await handler(update, context)
+
     async def check_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
         """Check if user is at least an admin in the chat."""
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
+
+        cached = self._admin_cache.get(chat_id)
+        if cached and time.monotonic() - cached[0] < ROLE_CACHE_TTL:
+            return user_id in cached[1]
         
         try:
-            member_info = await context.bot.get_chat_member(chat_id, user_id)
-            status = member_info.status
-            # Map Telegram statuses to something akin to role priorities
-            if status in ['administrator', 'creator']:
-                return True
-            return False
+            # One call returns every administrator and the creator, so the
+            # whole chat is answered from memory until the entry expires
+            admins = await context.bot.get_chat_administrators(chat_id)
         except Exception as e:
             logger.error(f"Admin check error: {e}")
             return False
 
+        admin_ids = {admin.user.id for admin in admins}
+        self._admin_cache[chat_id] = (time.monotonic(), admin_ids)
+        return user_id in admin_ids
+
     async def get_user_role(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """Attempt to retrieve the user's stored role from the DB if present; fallback to Telegram chat status."""
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
-        cursor = self.db.conn.cursor()
-        cursor.execute("SELECT role FROM users WHERE user_id=? AND group_id=?", (user_id, chat_id))
-        row = cursor.fetchone()
+        key = (chat_id, user_id)
+
+        cached = self._role_cache.get(key)
+        if cached and time.monotonic() - cached[0] < ROLE_CACHE_TTL:
+            return cached[1]
+
+        row = await self.db.fetchone(SQL_SELECT_ROLE, (user_id, chat_id))
 
         if row:
-            return row[0]
+            role = row[0]
         else:
             # Fallback to actual Telegram role
             try:
                 member_info = await context.bot.get_chat_member(chat_id, user_id)
-                return member_info.status
+                role = member_info.status
             except Exception:
                 return "member"
 
+        self._role_cache[key] = (time.monotonic(), role)
+        return role
+
+    def invalidate_user_cache(self, chat_id: int, user_id: int):
+        """Drop the chat's cached admin set and the user's role after a role change."""
+        self._admin_cache.pop(chat_id, None)
+        self._role_cache.pop((chat_id, user_id), None)
+
     async def cmd_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Initial welcome message and registration."""
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
         username = update.effective_user.username or "NoUsername"
         
-        # Make sure a record for the group and the user is in the DB
-        cursor = self.db.conn.cursor()
-        
-        # Insert group if not present
-        cursor.execute("INSERT OR IGNORE INTO groups (group_id, title, created_at) VALUES (?, ?, ?)",
-                       (chat_id, update.effective_chat.title or "Unnamed Group", datetime.now()))
-        
-        # Insert user if not present
-        cursor.execute("""INSERT OR IGNORE INTO users (user_id, group_id, username, joined_at)
-                          VALUES (?, ?, ?, ?)""",
-                       (user_id, chat_id, username, datetime.now()))
-        self.db.conn.commit()
-
-        welcome_text = (
-            "Hello! I'm your expanded GroupManager Bot.\n"
-            "• Use /help to see what I can do.\n"
-            "• Use /setwelcome <message> to customize an automatic welcome.\n"
-            "• Use /setrules <rules> to set or update the group rules.\n\n"
-            "Happy managing!"
-        )
-        await update.message.reply_text(welcome_text)
+        # Make sure a record for the group and the user is in the DB (written on the next flush)
+        self.queue_registration(chat_id, update.effective_chat.title or "Unnamed Group", user_id, username)
+
+        await update.message.reply_text(_WELCOME_TEXT)
 
     async def cmd_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Display help text for all commands."""
-        help_text = (
-            "**Available Commands:**\n\n"
-            "/start - Bot introduction and setup\n"
-            "/help - Display this help message\n"
-            "/rules - Show current group rules\n"
-            "/setrules <rules> - Set or update group rules (admin only)\n"
-            "/ban <user_id> [reason] - Ban a user (admin only)\n"
-            "/unban <user_id> - Unban a user (admin only)\n"
-            "/mute <user_id> [minutes] - Temporarily mute a user (admin only)\n"
-            "/unmute <user_id> - Unmute a user (admin only)\n"
-            "/warn <user_id> [reason] - Warn a user (admin only)\n"
-            "/shorturl <url> - Shorten a given URL\n"
-            "/setwelcome <message> - Customize welcome message (admin only)\n"
-            "/points <user_id> - Check a user’s points\n"
-            "/poll <question>|<option1>|<option2>|... - Create a poll\n"
-            "/vote <poll_id> <option> - Vote on a poll\n"
-            "/stoppoll <poll_id> - Stop an active poll (admin only)\n"
-            "/createevent <title>|<YYYY-MM-DD HH:MM>|<description> - Schedule an event\n"
-            "/rsvp <event_id> <yes/no/maybe> - RSVP to an event\n"
-            "/showevents - Show upcoming events\n"
-            "/promote <user_id> <role> - Promote a user to a higher role (owner/admin only)\n"
-            "/demote <user_id> - Demote a user to a lower role (owner/admin only)\n"
-            "/lockdown <on/off> - Restrict or allow messages for most users\n"
-        )
-        await update.message.reply_markdown(help_text)
+        await update.message.reply_markdown(_HELP_TEXT)
 
     async def cmd_rules(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show current group rules."""
         chat_id = update.effective_chat.id
-        cursor = self.db.conn.cursor()
-        cursor.execute("SELECT rules FROM groups WHERE group_id=?", (chat_id,))
-        row = cursor.fetchone()
+        row = await self.db.fetchone("SELECT rules FROM groups WHERE group_id=?", (chat_id,))
 
         if row and row[0]:
             await update.message.reply_text(f"**Group Rules:**\n{row[0]}")
         else:
             await update.message.reply_text("No rules set. Use /setrules <rules> to add some.")
 
+    @admin_only
     async def cmd_setrules(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Set or update the group rules (admin only)."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ You must be an admin to use this command.")
-            return
-        
         if not context.args:
             await update.message.reply_text("Usage: /setrules <rules text>")
             return
@@ -282,18 +736,15 @@ class GroupManager:
         new_rules = " ".join(context.args)
         chat_id = update.effective_chat.id
 
-        cursor = self.db.conn.cursor()
-        cursor.execute("UPDATE groups SET rules=? WHERE group_id=?", (new_rules, chat_id))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute("UPDATE groups SET rules=? WHERE group_id=?", (new_rules, chat_id))
+            await conn.commit()
         
         await update.message.reply_text("✅ Rules updated successfully.")
 
+    @admin_only
     async def cmd_ban(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Ban a user from the group."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-
         try:
             if not context.args:
                 await update.message.reply_text("Usage: /ban <user_id> [reason]")
@@ -311,12 +762,9 @@ class GroupManager:
             await update.message.reply_text(f"Failed to ban user: {str(e)}")
             logger.error(f"Ban error: {e}")
 
+    @admin_only
     async def cmd_unban(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Unban a user from the group."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-
         if not context.args:
             await update.message.reply_text("Usage: /unban <user_id>")
             return
@@ -332,12 +780,9 @@ class GroupManager:
             await update.message.reply_text(f"Error unbanning user: {str(e)}")
             logger.error(f"Unban error: {e}")
 
+    @admin_only
     async def cmd_mute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Mute a user for X minutes."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-        
         if not context.args:
             await update.message.reply_text("Usage: /mute <user_id> [minutes]")
             return
@@ -358,12 +803,9 @@ class GroupManager:
             await update.message.reply_text(f"Failed to mute user: {str(e)}")
             logger.error(f"Mute error: {e}")
 
+    @admin_only
     async def cmd_unmute(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Unmute a user."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-
         if not context.args:
             await update.message.reply_text("Usage: /unmute <user_id>")
             return
@@ -373,26 +815,16 @@ class GroupManager:
             await context.bot.restrict_chat_member(
                 chat_id=update.effective_chat.id,
                 user_id=user_id,
-                permissions=ChatPermissions(can_send_messages=True,
-                                            can_send_media_messages=True,
-                                            can_send_polls=True,
-                                            can_send_other_messages=True,
-                                            can_add_web_page_previews=True,
-                                            can_change_info=False,
-                                            can_invite_users=True,
-                                            can_pin_messages=False)
+                permissions=self._PERMS_UNMUTED
             )
             await update.message.reply_text(f"User {user_id} has been unmuted.")
         except Exception as e:
             await update.message.reply_text(f"Failed to unmute user: {str(e)}")
             logger.error(f"Unmute error: {e}")
 
+    @admin_only
     async def cmd_warn(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Warn a user."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-
         if not context.args:
             await update.message.reply_text("Usage: /warn <user_id> [reason]")
             return
@@ -401,19 +833,11 @@ class GroupManager:
         reason = " ".join(context.args[1:]) if len(context.args) > 1 else "No reason provided"
 
         chat_id = update.effective_chat.id
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            UPDATE users
-            SET warnings = warnings + 1
-            WHERE user_id = ? AND group_id = ?
-        """, (user_id, chat_id))
-        self.db.conn.commit()
-
-        # Get updated warnings count
-        cursor.execute("""
-            SELECT warnings FROM users WHERE user_id=? AND group_id=?
-        """, (user_id, chat_id))
-        row = cursor.fetchone()
+        async with self.db.writer() as conn:
+            # Bump and read back the warnings count in one statement
+            async with conn.execute(SQL_WARN_USER, (user_id, chat_id)) as cursor:
+                row = await cursor.fetchone()
+            await conn.commit()
         if row:
             warning_count = row[0]
             await update.message.reply_text(
@@ -438,7 +862,7 @@ class GroupManager:
             return
             
         url = context.args[0]
-        if not re.match(r'https?://', url):
+        if not _URL_SCHEME_RE.match(url):
             url = 'http://' + url
 
         short_url = await self.shorten_url(url, update.effective_user.id)
@@ -446,33 +870,35 @@ class GroupManager:
 
     async def shorten_url(self, original_url: str, created_by: int) -> str:
         """Generate and store a short code for a given URL."""
-        short_code = ''.join(random.choices(string.ascii_letters + string.digits, k=6))
-        short_link = f"https://t.ly/{short_code}"
-
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            INSERT INTO shortened_urls (short_code, original_url, created_at, created_by) 
-            VALUES (?, ?, ?, ?)
-        """, (short_code, original_url, datetime.now(), created_by))
-        self.db.conn.commit()
-
-        return short_link
-
+        created_at = int(time.time())
+        async with self.db.writer() as conn:
+            for _ in range(SHORT_CODE_ATTEMPTS):
+                short_code = secrets.token_urlsafe(5)[:6]
+                # RETURNING yields no row when the code already exists
+                async with conn.execute("""
+                    INSERT OR IGNORE INTO shortened_urls (short_code, original_url, created_at, created_by) 
+                    VALUES (?, ?, ?, ?)
+                    RETURNING short_code
+                """, (short_code, original_url, created_at, created_by)) as cursor:
+                    row = await cursor.fetchone()
+                if row:
+                    await conn.commit()
+                    return f"https://t.ly/{short_code}"
+
+        raise RuntimeError("Could not generate a unique short code")
+
+    @admin_only
     async def cmd_setwelcome(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Set the group's custom welcome message."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-        
         if not context.args:
             await update.message.reply_text("Usage: /setwelcome <message>")
             return
         
         chat_id = update.effective_chat.id
         new_welcome = " ".join(context.args)
-        cursor = self.db.conn.cursor()
-        cursor.execute("UPDATE groups SET welcome_message=? WHERE group_id=?", (new_welcome, chat_id))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute("UPDATE groups SET welcome_message=? WHERE group_id=?", (new_welcome, chat_id))
+            await conn.commit()
 
         await update.message.reply_text("✅ Welcome message updated.")
 
@@ -484,14 +910,12 @@ class GroupManager:
         else:
             user_id = update.effective_user.id
         
-        cursor = self.db.conn.cursor()
-        cursor.execute(
-            "SELECT points FROM users WHERE user_id=? AND group_id=?",
-            (user_id, chat_id)
-        )
-        row = cursor.fetchone()
-        if row:
-            await update.message.reply_text(f"User {user_id} has {row[0]} points.")
+        row = await self.db.fetchone(SQL_SELECT_POINTS, (user_id, chat_id))
+        # Include points earned since the last flush; a new user may have no row yet
+        pending = self._points[(chat_id, user_id)]
+        if row or pending:
+            points = (row[0] if row else 0) + pending
+            await update.message.reply_text(f"User {user_id} has {points} points.")
         else:
             await update.message.reply_text("User not found in the database.")
 
@@ -508,16 +932,23 @@ class GroupManager:
             return
 
         question = parts[0]
-        options = parts[1:]
+        # poll_options keeps one row per option text; drop repeats so the reply matches
+        options = list(dict.fromkeys(parts[1:]))
         chat_id = update.effective_chat.id
         
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            INSERT INTO polls (group_id, question, options, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (chat_id, question, json.dumps(options), datetime.now()))
-        poll_id = cursor.lastrowid
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            async with conn.execute("""
+                INSERT INTO polls (group_id, question, created_at)
+                VALUES (?, ?, ?)
+                RETURNING poll_id
+            """, (chat_id, question, int(time.time()))) as cursor:
+                (poll_id,) = await cursor.fetchone()
+            # rowid order keeps the options in the order they were given
+            await conn.executemany(
+                "INSERT OR IGNORE INTO poll_options (poll_id, option_text) VALUES (?, ?)",
+                [(poll_id, opt) for opt in options]
+            )
+            await conn.commit()
 
         await update.message.reply_text(
             f"Poll created (ID: {poll_id}): {question}\nOptions:\n" +
@@ -535,67 +966,71 @@ class GroupManager:
         selected_option = " ".join(context.args[1:])
         user_id = update.effective_user.id
         
-        # Check if poll is active
-        cursor = self.db.conn.cursor()
-        cursor.execute("SELECT options, is_active FROM polls WHERE poll_id=?", (poll_id,))
-        row = cursor.fetchone()
+        # Check if poll is active and the option belongs to it
+        row = await self.db.fetchone("""
+            SELECT is_active, EXISTS (
+                SELECT 1 FROM poll_options WHERE poll_id = polls.poll_id AND option_text = ?
+            )
+            FROM polls WHERE poll_id=?
+        """, (selected_option, poll_id))
         if not row:
             await update.message.reply_text("No such poll found.")
             return
-        options, is_active = row
+        is_active, valid_option = row
         if not is_active:
             await update.message.reply_text("Poll is not active.")
             return
 
-        options_list = json.loads(options)
-        if selected_option not in options_list:
+        if not valid_option:
             await update.message.reply_text("Invalid option. Check poll options.")
             return
 
         # Record the vote
-        cursor.execute("""
-            INSERT INTO poll_responses (poll_id, user_id, selected_option)
-            VALUES (?, ?, ?)
-        """, (poll_id, user_id, selected_option))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute("""
+                INSERT INTO poll_responses (poll_id, user_id, selected_option)
+                VALUES (?, ?, ?)
+            """, (poll_id, user_id, selected_option))
+            await conn.commit()
 
         await update.message.reply_text(f"Vote recorded for poll {poll_id}.")
 
+    @admin_only
     async def cmd_stoppoll(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Stop a poll and show final results."""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-
         if not context.args:
             await update.message.reply_text("Usage: /stoppoll <poll_id>")
             return
 
         poll_id = int(context.args[0])
-        cursor = self.db.conn.cursor()
-        cursor.execute("SELECT options FROM polls WHERE poll_id=?", (poll_id,))
-        row = cursor.fetchone()
+        # Mark poll as inactive
+        async with self.db.writer() as conn:
+            async with conn.execute(
+                "UPDATE polls SET is_active=0 WHERE poll_id=? RETURNING poll_id", (poll_id,)
+            ) as cursor:
+                row = await cursor.fetchone()
+            await conn.commit()
 
         if not row:
             await update.message.reply_text("No poll found with that ID.")
             return
-        
-        # Mark poll as inactive
-        cursor.execute("UPDATE polls SET is_active=0 WHERE poll_id=?", (poll_id,))
-        self.db.conn.commit()
-
-        options_list = json.loads(row[0])
-        # Tally votes
-        results = {opt: 0 for opt in options_list}
-        cursor.execute("SELECT selected_option FROM poll_responses WHERE poll_id=?", (poll_id,))
-        votes = cursor.fetchall()
-        for (selected,) in votes:
-            if selected in results:
-                results[selected] += 1
+
+        # Tally votes in SQL; options with no votes come back with a zero count
+        async with self.db.reader() as conn:
+            async with conn.execute("""
+                SELECT po.option_text, COUNT(pr.id)
+                FROM poll_options po
+                LEFT JOIN poll_responses pr
+                    ON pr.poll_id = po.poll_id AND pr.selected_option = po.option_text
+                WHERE po.poll_id=?
+                GROUP BY po.rowid
+                ORDER BY po.rowid
+            """, (poll_id,)) as cursor:
+                results = await cursor.fetchall()
         
         result_text = f"**Poll {poll_id} Results:**\n"
-        for opt in results:
-            result_text += f"{opt}: {results[opt]} votes\n"
+        for opt, votes in results:
+            result_text += f"{opt}: {votes} votes\n"
         await update.message.reply_markdown(result_text)
 
     async def cmd_createevent(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -621,12 +1056,12 @@ class GroupManager:
 
         chat_id = update.effective_chat.id
         user_id = update.effective_user.id
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            INSERT INTO events (group_id, title, scheduled_time, description, created_by)
-            VALUES (?, ?, ?, ?, ?)
-        """, (chat_id, title, scheduled_time, description, user_id))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute("""
+                INSERT INTO events (group_id, title, scheduled_time, description, created_by)
+                VALUES (?, ?, ?, ?, ?)
+            """, (chat_id, title, scheduled_time, description, user_id))
+            await conn.commit()
         
         await update.message.reply_text(f"Event '{title}' created for {scheduled_time}.")
 
@@ -643,55 +1078,48 @@ class GroupManager:
             return
         
         user_id = update.effective_user.id
-        cursor = self.db.conn.cursor()
         
         # Check if event exists
-        cursor.execute("SELECT title FROM events WHERE event_id=?", (event_id,))
-        row = cursor.fetchone()
+        row = await self.db.fetchone("SELECT title FROM events WHERE event_id=?", (event_id,))
         if not row:
             await update.message.reply_text("No such event found.")
             return
         event_title = row[0]
         
         # Insert or update RSVP
-        cursor.execute("""
-            INSERT INTO event_rsvps (event_id, user_id, status)
-            VALUES (?, ?, ?)
-            ON CONFLICT(event_id, user_id) DO UPDATE SET status=excluded.status
-        """, (event_id, user_id, status))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute("""
+                INSERT INTO event_rsvps (event_id, user_id, status)
+                VALUES (?, ?, ?)
+                ON CONFLICT(event_id, user_id) DO UPDATE SET status=excluded.status
+            """, (event_id, user_id, status))
+            await conn.commit()
 
         await update.message.reply_text(f"RSVP recorded for event '{event_title}'. You answered '{status}'.")
 
     async def cmd_showevents(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show upcoming events."""
         chat_id = update.effective_chat.id
-        cursor = self.db.conn.cursor()
         now = datetime.now()
-        cursor.execute("""
-            SELECT event_id, title, scheduled_time 
-            FROM events
-            WHERE group_id=? AND scheduled_time >= ?
-            ORDER BY scheduled_time ASC
-        """, (chat_id, now))
-
-        rows = cursor.fetchall()
-        if not rows:
+        async with self.db.reader() as conn:
+            async with conn.execute("""
+                SELECT event_id, title, scheduled_time 
+                FROM events
+                WHERE group_id=? AND scheduled_time >= ?
+                ORDER BY scheduled_time ASC
+                LIMIT ?
+            """, (chat_id, now, SHOW_EVENTS_LIMIT)) as cursor:
+                lines = [f"Event {eid}: {title} at {stime}" async for (eid, title, stime) in cursor]
+        if not lines:
             await update.message.reply_text("No upcoming events.")
             return
         
-        msg = "**Upcoming Events:**\n"
-        for (eid, title, stime) in rows:
-            msg += f"Event {eid}: {title} at {stime}\n"
+        msg = "**Upcoming Events:**\n" + "\n".join(lines)
         await update.message.reply_markdown(msg)
 
+    @admin_only
     async def cmd_promote(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Promote a user to a higher role: /promote <user_id> <role>"""
-        # Must be group owner or top-level admin
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-        
         if len(context.args) < 2:
             await update.message.reply_text("Usage: /promote <user_id> <role>")
             return
@@ -711,21 +1139,16 @@ class GroupManager:
             await update.message.reply_text("Cannot promote to a role >= your own role.")
             return
 
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            UPDATE users SET role=? WHERE user_id=? AND group_id=?
-        """, (new_role, user_id, chat_id))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute(SQL_SET_ROLE, (new_role, user_id, chat_id))
+            await conn.commit()
+        self.invalidate_user_cache(chat_id, user_id)
         
         await update.message.reply_text(f"User {user_id} promoted to {new_role}.")
 
+    @admin_only
     async def cmd_demote(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Demote a user to a lower role: /demote <user_id>"""
-        # Must be group owner or top-level admin
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-
         if len(context.args) < 1:
             await update.message.reply_text("Usage: /demote <user_id>")
             return
@@ -737,11 +1160,7 @@ class GroupManager:
         current_user_role = await self.get_user_role(update, context)
 
         # Retrieve target user's role
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            SELECT role FROM users WHERE user_id=? AND group_id=?
-        """, (user_id, chat_id))
-        row = cursor.fetchone()
+        row = await self.db.fetchone(SQL_SELECT_ROLE, (user_id, chat_id))
         if not row:
             await update.message.reply_text("User not found in the database.")
             return
@@ -755,89 +1174,69 @@ class GroupManager:
         # Downgrade logic: owner -> admin, admin -> moderator, moderator -> member, etc.
         old_priority = get_role_priority(target_role)
         new_priority = old_priority - 1
-        # Determine new role name from new_priority
-        for r, p in [('owner',4), ('administrator',3), ('moderator',2), ('member',1)]:
-            if p == new_priority:
-                new_role = r
-                break
-        else:
-            new_role = 'member'
+        new_role = _PRIORITY_TO_ROLE.get(new_priority)
+        if new_role is None:
+            await update.message.reply_text(f"User {user_id} already has the lowest role.")
+            return
 
-        cursor.execute("""
-            UPDATE users SET role=? WHERE user_id=? AND group_id=?
-        """, (new_role, user_id, chat_id))
-        self.db.conn.commit()
+        async with self.db.writer() as conn:
+            await conn.execute(SQL_SET_ROLE, (new_role, user_id, chat_id))
+            await conn.commit()
+        self.invalidate_user_cache(chat_id, user_id)
 
         await update.message.reply_text(f"User {user_id} has been demoted to {new_role}.")
 
+    @admin_only
     async def cmd_lockdown(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Restrict or allow messages for non-admins. Usage: /lockdown <on/off>"""
-        if not await self.check_admin(update, context):
-            await update.message.reply_text("❌ Admin privileges required.")
-            return
-        
         if not context.args:
             await update.message.reply_text("Usage: /lockdown <on/off>")
             return
         
         mode = context.args[0].lower()
+        if mode not in ("on", "off"):
+            await update.message.reply_text("Use /lockdown <on/off>")
+            return
+
         chat_id = update.effective_chat.id
+        locked = mode == "on"
         try:
-            if mode == "on":
-                # Restrict messages for members
-                await context.bot.set_chat_permissions(
-                    chat_id=chat_id,
-                    permissions=ChatPermissions(
-                        can_send_messages=False,
-                        can_send_media_messages=False,
-                        can_send_polls=False,
-                        can_send_other_messages=False,
-                        can_add_web_page_previews=False
-                    )
-                )
+            # Restrict messages for members, or restore normal permission
+            await context.bot.set_chat_permissions(
+                chat_id=chat_id,
+                permissions=self._PERMS_LOCKED if locked else self._PERMS_OPEN
+            )
+            if locked:
                 await update.message.reply_text("Lockdown mode enabled. Non-admins cannot send messages.")
-            elif mode == "off":
-                # Restore normal permission
-                await context.bot.set_chat_permissions(
-                    chat_id=chat_id,
-                    permissions=ChatPermissions(
-                        can_send_messages=True,
-                        can_send_media_messages=True,
-                        can_send_polls=True,
-                        can_send_other_messages=True,
-                        can_add_web_page_previews=True
-                    )
-                )
-                await update.message.reply_text("Lockdown mode disabled. Everyone can send messages now.")
             else:
-                await update.message.reply_text("Use /lockdown <on/off>")
+                await update.message.reply_text("Lockdown mode disabled. Everyone can send messages now.")
         except Exception as e:
             logger.error(f"Lockdown error: {e}")
             await update.message.reply_text("Failed to change lockdown mode.")
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle all text messages (non-command). For advanced spam checks, awarding points, etc."""
-        chat_id = update.effective_chat.id
-        user_id = update.effective_user.id
-        username = update.effective_user.username or "NoUsername"
         message_text = update.message.text
+        user = update.effective_user
+        # Nothing to log or reward for blank text or other bots
+        if not message_text or message_text.isspace() or user is None or user.is_bot:
+            return
 
-        # Ensure user is in DB
-        cursor = self.db.conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO users (user_id, group_id, username, joined_at) VALUES (?, ?, ?, ?)",
-                       (user_id, chat_id, username, datetime.now()))
-        self.db.conn.commit()
+        chat_id = update.effective_chat.id
+        user_id = user.id
+        username = user.username or "NoUsername"
+        title = update.effective_chat.title or "Unnamed Group"
 
-        # Simple point awarding system
-        cursor.execute("UPDATE users SET points = points + 1 WHERE user_id=? AND group_id=?", (user_id, chat_id))
-        self.db.conn.commit()
+        # Simple point awarding system; the points flush upserts the user row
+        key = (chat_id, user_id)
+        self._points[key] += 1
+        self._point_owners[key] = (title, username)
 
-        # Save message to DB (for logging, analytics, etc.)
-        cursor.execute("""
-            INSERT INTO messages (group_id, user_id, content, timestamp)
-            VALUES (?, ?, ?, ?)
-        """, (chat_id, user_id, message_text, datetime.now()))
-        self.db.conn.commit()
+        # Save message to DB (for logging, analytics, etc.) on the next flush. The
+        # registration lands in the same transaction, ahead of the message row that
+        # references it, so a newcomer's first message never trips the foreign key.
+        self.queue_registration(chat_id, title, user_id, username)
+        self.buffer_message(chat_id, user_id, message_text)
 
         # Optionally, check for spam/triggers here (placeholder)
         # ...
@@ -853,16 +1252,42 @@ class GroupManager:
         query = update.callback_query
         await query.answer()
 
-        # Perform logic based on query.data
-        if query.data.startswith("some_action"):
-            await query.edit_message_text(text="Action handled!")
-        else:
+        # query.data is "<action>" or "<action>:<payload>"
+        action, _, payload = (query.data or "").partition(":")
+        handler = self._callback_handlers.get(action)
+        if handler is None:
             await query.edit_message_text(text="Unknown action.")
+            return
+        await handler(query, payload)
+
+    async def _handle_some_action(self, query, payload: str):
+        await query.edit_message_text(text="Action handled!")
 
     def run(self):
-        """Start the bot with long-polling."""
-        self.application.run_polling()
+        """Start the bot with a webhook when WEBHOOK_URL is set, otherwise with long-polling."""
+        webhook_url = os.environ.get("WEBHOOK_URL")
+        if webhook_url:
+            # Without a secret anyone who finds the URL can post forged updates
+            secret = os.environ.get("WEBHOOK_SECRET")
+            if not secret:
+                raise SystemExit("Set the WEBHOOK_SECRET environment variable when WEBHOOK_URL is set.")
+            self.application.run_webhook(
+                listen=os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+                port=int(os.environ.get("WEBHOOK_PORT", "8443")),
+                secret_token=secret,
+                webhook_url=webhook_url
+            )
+        else:
+            self.application.run_polling()
+
+def main():
+    token = os.environ.get("BOT_TOKEN")
+    if not token:
+        raise SystemExit("Set the BOT_TOKEN environment variable to your bot's token.")
+    # run_polling/run_webhook create their loop through the policy, so this is enough
+    if uvloop is not None:
+        uvloop.install()
+    GroupManager(token).run()
 
 if __name__ == '__main__':
-    bot = GroupManager("8131621643:AAFKkU4pWnDhLcYXTjMsTbeY11gQalaUSNs")
-    bot.run()
+    main()
@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import sys
+import tempfile
+import types
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+
+def make_update(text, user_id=2, chat_id=100, title="G"):
+    message = types.SimpleNamespace(text=text, replies=[])
+
+    async def reply_text(reply, **kwargs):
+        message.replies.append(reply)
+
+    message.reply_text = reply_text
+    return types.SimpleNamespace(
+        effective_chat=types.SimpleNamespace(id=chat_id, title=title),
+        effective_user=types.SimpleNamespace(id=user_id, username=f"u{user_id}", is_bot=False),
+        message=message,
+        effective_message=message,
+    )
+
+
+LEGACY_SCHEMA = """
+    CREATE TABLE groups (group_id INTEGER PRIMARY KEY, title TEXT);
+    CREATE TABLE users (user_id INTEGER, group_id INTEGER, PRIMARY KEY (user_id, group_id));
+"""
+
+
+class DatabaseTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.manager = bot.GroupManager("123:abc")
+        self.manager.db = bot.Database(os.path.join(self.tmp.name, "test.db"))
+        await self.manager.db.connect()
+
+    async def asyncTearDown(self):
+        await self.manager.db.close()
+        self.tmp.cleanup()
+
+    async def query(self, sql):
+        async with self.manager.db.reader() as conn:
+            return list(await conn.execute_fetchall(sql))
+
+
+class WriteBehindTests(DatabaseTestCase):
+    async def test_first_message_from_unseen_user_in_unseen_chat(self):
+        await self.manager.handle_message(make_update("hello"), None)
+        await self.manager.flush_pending()
+
+        self.assertEqual(await self.query("SELECT group_id, title FROM groups"), [(100, "G")])
+        self.assertEqual(await self.query("SELECT user_id, group_id, username FROM users"), [(2, 100, "u2")])
+        self.assertEqual(await self.query("SELECT group_id, user_id, content FROM messages"), [(100, 2, "hello")])
+
+        await self.manager.flush_points()
+        self.assertEqual(await self.query("SELECT points FROM users"), [(1,)])
+
+    async def test_failed_flush_requeues_its_batch(self):
+        self.manager.queue_registration(100, "G", 1, "u1")
+        # No registration for user 3, so the messages foreign key rejects the batch
+        self.manager.buffer_message(100, 3, "orphan")
+        with self.assertRaises(Exception):
+            await self.manager.flush_pending()
+
+        self.assertEqual(self.manager._pending_upserts, {(100, 1): ("G", "u1")})
+        self.assertEqual([row[:3] for row in self.manager._msg_buffer], [(100, 3, "orphan")])
+        self.assertEqual(await self.query("SELECT user_id FROM users"), [])
+
+    async def test_requeued_message_backlog_is_capped(self):
+        self.manager.buffer_message(100, 3, "orphan")
+        for i in range(4):
+            self.manager.buffer_message(100, 3, f"newer {i}")
+        with mock.patch.object(bot, "MESSAGE_BACKLOG_MAX_ROWS", 3), self.assertLogs("bot", "ERROR"):
+            with self.assertRaises(Exception):
+                await self.manager.flush_pending()
+
+        self.assertEqual([row[2] for row in self.manager._msg_buffer], ["newer 1", "newer 2", "newer 3"])
+
+    async def test_shutdown_applies_points_and_closes_after_failed_flush(self):
+        await self.manager.handle_message(make_update("hello"), None)
+        # An orphan message makes the final message flush fail
+        self.manager.buffer_message(100, 3, "orphan")
+        with self.assertRaises(Exception):
+            await self.manager.post_shutdown(self.manager.application)
+
+        self.assertIsNone(self.manager.db.pool._writer)
+        conn = sqlite3.connect(self.manager.db.pool.db_name)
+        try:
+            self.assertEqual(conn.execute("SELECT user_id, points FROM users").fetchall(), [(2, 1)])
+        finally:
+            conn.close()
+
+
+    async def test_points_of_new_user_include_unflushed_count(self):
+        await self.manager.handle_message(make_update("hello"), None)
+        update = make_update("/points")
+        await self.manager.cmd_points(update, types.SimpleNamespace(args=[]))
+
+        self.assertEqual(update.message.replies, ["User 2 has 1 points."])
+
+
+class PollTests(DatabaseTestCase):
+    async def test_repeated_options_are_listed_once(self):
+        update = make_update("/poll Q|a|b|a")
+        await self.manager.cmd_poll(update, types.SimpleNamespace(args=["Q|a|b|a"]))
+
+        self.assertEqual(await self.query("SELECT option_text FROM poll_options ORDER BY rowid"), [("a",), ("b",)])
+        self.assertIn("Options:\n- a\n- b\nUse", update.message.replies[0])
+
+
+class SchemaTests(DatabaseTestCase):
+    async def test_fresh_database_has_one_unique_rsvp_index(self):
+        rows = await self.query("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='event_rsvps'")
+        self.assertEqual(rows, [("sqlite_autoindex_event_rsvps_1",)])
+
+    async def open_legacy(self, script):
+        """Create a database from raw DDL/DML, then open it through Database."""
+        path = os.path.join(self.tmp.name, "legacy.db")
+        conn = sqlite3.connect(path)
+        conn.executescript(script)
+        conn.close()
+        db = bot.Database(path)
+        await db.connect()
+        self.addAsyncCleanup(db.close)
+        return db
+
+    async def test_rebuilt_legacy_messages_get_epoch_timestamps(self):
+        db = await self.open_legacy(LEGACY_SCHEMA + """
+            CREATE TABLE messages (
+                message_id INTEGER PRIMARY KEY, group_id INTEGER, user_id INTEGER,
+                content TEXT, timestamp TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            );
+            INSERT INTO messages VALUES (1, 100, 2, 'old', '2024-01-02 03:04:05.000000');
+        """)
+        async with db.reader() as reader:
+            rows = await reader.execute_fetchall("SELECT typeof(timestamp) FROM messages")
+            (version,) = (await reader.execute_fetchall("PRAGMA user_version"))[0]
+        self.assertEqual(list(rows), [("integer",)])
+        self.assertEqual(version, 2)
+
+    async def test_legacy_poll_options_are_copied_and_malformed_ones_skipped(self):
+        db = await self.open_legacy(LEGACY_SCHEMA + """
+            CREATE TABLE polls (
+                poll_id INTEGER PRIMARY KEY AUTOINCREMENT, group_id INTEGER,
+                question TEXT, options TEXT, created_at TIMESTAMP, is_active INTEGER DEFAULT 1
+            );
+            INSERT INTO polls (question, options) VALUES ('ok', '["a", "b"]'), ('broken', 'a|b');
+        """)
+        async with db.reader() as reader:
+            rows = await reader.execute_fetchall("SELECT poll_id, option_text FROM poll_options ORDER BY rowid")
+        self.assertEqual(list(rows), [(1, "a"), (1, "b")])
+
+    async def test_interrupted_messages_rebuild_resumes(self):
+        # State left by a startup that renamed the table and created the new one, then failed
+        db = await self.open_legacy(LEGACY_SCHEMA + """
+            CREATE TABLE messages_old (
+                message_id INTEGER PRIMARY KEY, group_id INTEGER, user_id INTEGER,
+                content TEXT, timestamp TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users (user_id)
+            );
+            INSERT INTO messages_old VALUES (1, 100, 2, 'old', 1700000000);
+            CREATE TABLE messages (
+                message_id INTEGER PRIMARY KEY, group_id INTEGER, user_id INTEGER,
+                content TEXT, timestamp INTEGER,
+                FOREIGN KEY (group_id) REFERENCES groups (group_id),
+                FOREIGN KEY (user_id, group_id) REFERENCES users (user_id, group_id)
+            );
+        """)
+        async with db.reader() as reader:
+            rows = await reader.execute_fetchall("SELECT message_id, content FROM messages")
+            leftovers = await reader.execute_fetchall("SELECT name FROM sqlite_master WHERE name='messages_old'")
+        self.assertEqual(list(rows), [(1, "old")])
+        self.assertEqual(list(leftovers), [])
+
+if __name__ == "__main__":
+    unittest.main()